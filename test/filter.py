@@ -3,9 +3,131 @@ import uuid
 import types
 import typing
 import sys
+import time
 import traceback
 from proxad import RawFlow
 
+try:
+    from re import _parser as sre_parse
+except ImportError:  # python < 3.11
+    import sre_parse
+
+try:
+    from cachetools import TTLCache
+except ImportError:
+    TTLCache = None
+
+try:
+    import hyperscan
+except ImportError:
+    hyperscan = None
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+try:
+    import re2
+except ImportError:
+    re2 = None
+
+
+# Patterns that run on attacker controlled data prefer RE2, which matches in linear time
+# The patterns RE2 does not support (backreferences, lookarounds) fall back to re
+def compile_linear(pattern):
+    if re2 is not None:
+        try:
+            return re2.compile(pattern)
+        except re2.error:
+            pass
+    return re.compile(pattern)
+
+
+INLINE_FLAGS_REGEX = re.compile(r"\(\?([aiLmsux]+)\)")
+
+
+# Global flags like (?i) are only valid at the start of the whole expression,
+# before the pattern is joined with others they become a scoped group (?i:...)
+def scope_flags(pattern):
+    text = pattern.decode("latin-1") if isinstance(pattern, bytes) else pattern
+    flags = ""
+    while match := INLINE_FLAGS_REGEX.match(text):
+        flags += match.group(1)
+        text = text[match.end() :]
+    if flags:
+        # In verbose mode a trailing comment would swallow the closing parenthesis
+        text = f"(?{flags}:{text}{chr(10) if 'x' in flags else ''})"
+    return text.encode("latin-1") if isinstance(pattern, bytes) else text
+
+
+# Longest literal that every match of the pattern contains, None if there is none
+def required_literal(pattern):
+    parsed = sre_parse.parse(pattern)
+    if parsed.state.flags & re.IGNORECASE:
+        return None
+
+    best = run = []
+    for op, av in parsed:
+        run = run + [av] if op == sre_parse.LITERAL else []
+        if len(run) > len(best):
+            best = run
+    return bytes(best) or None
+
+
+# Every (op, av) of a parsed pattern, including the ones in groups, branches and repeats
+def walk_pattern(parsed):
+    for op, av in parsed:
+        yield op, av
+        for item in av if isinstance(av, (tuple, list)) else ():
+            for sub in item if isinstance(item, list) else [item]:
+                if isinstance(sub, sre_parse.SubPattern):
+                    yield from walk_pattern(sub)
+
+
+# Assertions that look at the byte after the match ($, \Z, \b, \B)
+NEXT_BYTE_ASSERTIONS = (
+    sre_parse.AT_END,
+    sre_parse.AT_END_STRING,
+    sre_parse.AT_BOUNDARY,
+    sre_parse.AT_NON_BOUNDARY,
+)
+
+
+# True if a match can depend on the byte after it, or on the end of the data
+def depends_on_next_byte(pattern):
+    return any(
+        op == sre_parse.AT and av in NEXT_BYTE_ASSERTIONS
+        for op, av in walk_pattern(sre_parse.parse(pattern))
+    )
+
+
+# Bytes before a chunk where a match ending in the chunk can start
+# None when the whole history is needed: no maximum length (e.g. .*), anchors
+# (^, $, \b), lookarounds and backreferences, which look at bytes outside of the match
+# or at its position
+def context_length(pattern):
+    parsed = sre_parse.parse(pattern)
+    width = parsed.getwidth()[1]
+    if width >= sre_parse.MAXREPEAT:
+        return None
+
+    for op, _av in walk_pattern(parsed):
+        if op in (
+            sre_parse.AT,
+            sre_parse.ASSERT,
+            sre_parse.ASSERT_NOT,
+            sre_parse.GROUPREF,
+            sre_parse.GROUPREF_EXISTS,
+        ):
+            return None
+    return max(width - 1, 0)
+
 
 # Use a fake python module to hold state between file reloads
 # When reloaded it will import the fake python module
@@ -30,23 +152,207 @@ FilterType = typing.Callable[[RawFlow, bytes], FilterOutput]
 # ------------------------------------------------------------------------------------------------ #
 
 # Regexes
-FLAG_REGEX = re.compile(rb"[A-Z0-9]{31}=")
+FLAG_REGEX = compile_linear(rb"[A-Z0-9]{31}=")
 FLAG_REPLACEMENT = b"GRAZIEDARIO"
 
 
 # Used to detect evil connections (check_is_evil)
 ALL_REGEXES = [rb"evilbanana"]
 
+# Keywords swapped by replace_keywords, e.g. {b"PING": b"PONG"}
+KEYWORD_REPLACEMENTS = {}
+
+# Per flow scan state of check_is_evil
+FLOW_STATE_TTL = 60  # seconds
+FLOW_STATE_LIMIT = 4000
+
 
 # ------------------------------------------------------------------------------------------------ #
 
 
-COMPILED_REGEXES = [re.compile(pattern) for pattern in ALL_REGEXES]
+# All the patterns joined in a single alternation, so the history is scanned only once
+COMBINED_REGEX = compile_linear(
+    b"|".join(b"(?:%s)" % scope_flags(p) for p in ALL_REGEXES) or rb"(?!)"
+)
+
+# When hyperscan is available the patterns are compiled in a streaming database,
+# so each flow only feeds the bytes added to client_history since the last call
+# Streams report $, \Z, \b and \B only on the next byte or when they are closed,
+# so a flow whose history ends right there would be missed: those patterns use re
+EVIL_DATABASE = None
+if hyperscan and ALL_REGEXES and not any(map(depends_on_next_byte, ALL_REGEXES)):
+    EVIL_DATABASE = hyperscan.Database(mode=hyperscan.HS_MODE_STREAM)
+    try:
+        EVIL_DATABASE.compile(
+            expressions=ALL_REGEXES,
+            ids=list(range(len(ALL_REGEXES))),
+            elements=len(ALL_REGEXES),
+            flags=[hyperscan.HS_FLAG_SINGLEMATCH] * len(ALL_REGEXES),
+        )
+    except hyperscan.error:
+        # Patterns hyperscan does not support (backreferences, lookarounds) use re
+        EVIL_DATABASE = None
+
+# Without hyperscan only the last bytes of the scanned history are carried over
+# None when a pattern needs the whole history (see context_length)
+EVIL_CONTEXTS = [context_length(p) for p in ALL_REGEXES]
+EVIL_TAIL_LENGTH = None if None in EVIL_CONTEXTS else max(EVIL_CONTEXTS, default=0)
+
+# A cheap substring test that runs before the regex, only if every pattern has a literal
+EVIL_LITERALS = [required_literal(p) for p in ALL_REGEXES]
+if not all(EVIL_LITERALS):
+    EVIL_LITERALS = None
+
+
+def search_evil(data):
+    if EVIL_LITERALS is not None and not any(lit in data for lit in EVIL_LITERALS):
+        return False
+    return COMBINED_REGEX.search(data) is not None
+
+
+# Kept as a global on purpose: after a reload the flows are scanned again from the start
+# Without cachetools a plain dict is used, capped to FLOW_STATE_LIMIT by check_is_evil
+EVIL_SCANS = TTLCache(maxsize=FLOW_STATE_LIMIT, ttl=FLOW_STATE_TTL) if TTLCache else {}
+
+
+class EvilScan:
+    def __init__(self):
+        self.evil = False
+        self.stream = None
+        self.reset()
+
+    # Scan the history again from the start
+    def reset(self):
+        self.offset = 0
+        self.last = b""
+        self.tail = b""
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+        if EVIL_DATABASE is not None:
+            # The stream does not keep the handler alive, hold a reference here
+            self.handler = self.on_match
+            self.stream = EVIL_DATABASE.stream(match_event_handler=self.handler)
+            self.stream.__enter__()
+
+    def on_match(self, *_rest):
+        self.evil = True
+
+    def feed(self, history):
+        # Once a match is found the flow stays evil
+        if self.evil:
+            return True
+
+        # The bytes scanned last time change when a filter that runs after this one
+        # returns a new chunk, the proxy then replaces the last chunk of the history
+        # Put check_is_evil last in CLIENT_FILTERS, or each chunk rescans the history
+        if history[self.offset - len(self.last) : self.offset] != self.last:
+            self.reset()
+
+        if len(history) <= self.offset:
+            return False
+
+        chunk = self.last = history[self.offset :]
+        self.offset = len(history)
+
+        if self.stream is not None:
+            self.stream.scan(chunk)
+        elif EVIL_TAIL_LENGTH is None:
+            # The patterns need the whole history, only the sticky flag saves work
+            self.evil = search_evil(history)
+        else:
+            # A match can start at most EVIL_TAIL_LENGTH bytes before the new chunk
+            data = self.tail + chunk
+            self.evil = search_evil(data)
+            self.tail = data[-EVIL_TAIL_LENGTH:] if EVIL_TAIL_LENGTH else b""
+        return self.evil
+
+
+# With numpy big chunks are scanned with a lookup table instead of the regex engine
+# The table and the length must be kept in sync with FLAG_REGEX
+# RE2 is faster than the table at every size, so numpy only replaces the re fallback
+# Measured on HTML-like data the table is faster than re from 2 KiB on
+FLAG_NUMPY = np is not None and isinstance(FLAG_REGEX, re.Pattern)
+FLAG_NUMPY_MIN_SIZE = 2048
+FLAG_BODY_LENGTH = 31
+if FLAG_NUMPY:
+    FLAG_CHARSET = np.zeros(256, np.bool_)
+    FLAG_CHARSET[ord("A") : ord("Z") + 1] = True
+    FLAG_CHARSET[ord("0") : ord("9") + 1] = True
+
+
+# Same as FLAG_REGEX.sub(FLAG_REPLACEMENT, data)
+def sub_flags(data):
+    if not FLAG_NUMPY or len(data) < FLAG_NUMPY_MIN_SIZE:
+        # Without a flag the data is returned as is instead of a copy made by sub
+        if not FLAG_REGEX.search(data):
+            return data
+        return FLAG_REGEX.sub(FLAG_REPLACEMENT, data)
+
+    array = np.frombuffer(data, np.uint8)
+    # runs[i] is the amount of flag characters in data[:i]
+    runs = np.zeros(len(array) + 1, np.int32)
+    np.cumsum(FLAG_CHARSET[array], out=runs[1:])
+
+    # A flag ends on every "=" preceded by FLAG_BODY_LENGTH flag characters
+    ends = np.flatnonzero(array == ord("="))
+    ends = ends[ends >= FLAG_BODY_LENGTH]
+    ends = ends[runs[ends] - runs[ends - FLAG_BODY_LENGTH] == FLAG_BODY_LENGTH]
+    if not len(ends):
+        return data
+
+    parts = []
+    prev = 0
+    for end in ends.tolist():
+        parts.append(data[prev : end - FLAG_BODY_LENGTH])
+        parts.append(FLAG_REPLACEMENT)
+        prev = end + 1
+    parts.append(data[prev:])
+    return b"".join(parts)
+
+
+# All the keywords are replaced in a single pass over the chunk
+# With pyahocorasick an automaton is used, otherwise an alternation of the keywords
+KEYWORD_AUTOMATON = None
+if ahocorasick is not None and KEYWORD_REPLACEMENTS:
+    KEYWORD_AUTOMATON = ahocorasick.Automaton()
+    for keyword, replacement in KEYWORD_REPLACEMENTS.items():
+        KEYWORD_AUTOMATON.add_word(
+            keyword.decode("latin-1"), (len(keyword), replacement)
+        )
+    KEYWORD_AUTOMATON.make_automaton()
+
+KEYWORD_REGEX = re.compile(
+    b"|".join(re.escape(k) for k in sorted(KEYWORD_REPLACEMENTS, key=len, reverse=True))
+    or rb"(?!)"
+)
+
+
+# This filter replaces the keywords in KEYWORD_REPLACEMENTS, combine it
+def replace_keywords(flow, chunk):
+    if KEYWORD_AUTOMATON is None:
+        replaced, count = KEYWORD_REGEX.subn(
+            lambda m: KEYWORD_REPLACEMENTS[m.group()], chunk
+        )
+        return replaced if count else None
+
+    parts = []
+    prev = 0
+    # latin-1 maps every byte to the code point with the same value
+    matches = KEYWORD_AUTOMATON.iter_long(chunk.decode("latin-1"))
+    for end, (length, replacement) in matches:
+        parts.append(chunk[prev : end + 1 - length])
+        parts.append(replacement)
+        prev = end + 1
+    if not parts:
+        return None
+    parts.append(chunk[prev:])
+    return b"".join(parts)
 
 
 # This filter always replaces the flag, combine it
 def replace_flag(flow, chunk):
-    return re.sub(FLAG_REGEX, FLAG_REPLACEMENT, chunk)
+    return sub_flags(chunk)
 
 
 # This filter always kills the connection, combine it
@@ -64,7 +370,13 @@ def send_error(*_rest):
 
 # Check if any of the patterns in ALL_REGEXES match the client_history
 def check_is_evil(flow, chunk):
-    return any(re.search(pattern, flow.client_history) for pattern in COMPILED_REGEXES)
+    scan = EVIL_SCANS.get(flow.id)
+    if scan is None:
+        if TTLCache is None and len(EVIL_SCANS) >= FLOW_STATE_LIMIT:
+            # The dict keeps the insertion order, the oldest flow is forgotten
+            del EVIL_SCANS[next(iter(EVIL_SCANS))]
+        scan = EVIL_SCANS[flow.id] = EvilScan()
+    return scan.feed(flow.client_history)
 
 
 # If the connection is recognized as evil, call DEFAULT_FILTER
@@ -99,6 +411,27 @@ SERVER_FILTERS: list[FilterType] = [default_on_evil]
 # Exception handling
 SKIP_ERROR = True  # skip filter if exception was raised
 PRINT_ERROR = True  # print traceback of exceptions
+PRINT_ERROR_RATE = 10  # max tracebacks printed per second
+
+
+# Token bucket, keeps a filter failing on every chunk from flooding the output
+class RateLimit:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def consume(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+ERROR_BUDGET = RateLimit(PRINT_ERROR_RATE)
 
 
 # if HTTP_SESSION_TRACK and not hasattr(state, "HTTP_SESSIONS"):
@@ -113,6 +446,10 @@ def run_filters(
     chunk: bytes,
     filters: list[FilterType],
 ) -> FilterOutput:
+    # Nothing to run, the proxy keeps the original chunk
+    if not filters:
+        return None
+
     current = chunk
     for f in filters:
         try:
@@ -121,8 +458,8 @@ def run_filters(
                 return ...
             if outcome is not None:
                 current = outcome
-        except Exception as e:
-            if PRINT_ERROR:
+        except Exception:
+            if PRINT_ERROR and ERROR_BUDGET.consume():
                 traceback.print_exc()
             if not SKIP_ERROR:
                 break
@@ -136,7 +473,7 @@ def client_raw_filter(flow: RawFlow, chunk: bytes) -> FilterOutput:
     #    if match:
     #        print("Found session_id:", match.group(1))
 
-    print("ELAPSED", (flow.last_time - flow.start_time).total_seconds())
+    # print("ELAPSED", (flow.last_time - flow.start_time).total_seconds())
     return run_filters(flow, chunk, CLIENT_FILTERS)
 
 
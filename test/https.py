@@ -2,6 +2,11 @@ import asyncio
 from aiohttp import web
 import ssl
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 PORT = 8443
 
 
@@ -30,4 +35,6 @@ async def main():
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
@@ -1,7 +1,14 @@
 import asyncio
+import os
 import random
+import socket
 import time
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 HOST = "0.0.0.0"
 PORT = 9000
 
@@ -9,70 +16,145 @@ CONCURRENT_CONNECTIONS = 1000
 MESSAGES_PER_CONNECTION = 4
 MAX_MSG_SIZE = 1024
 TICK_INTERVAL = 4
-
-
-async def tcp_echo_client(client_id: int):
-    start = time.perf_counter()
-    reader, writer = await asyncio.open_connection(HOST, PORT)
-    total_sent = 0
-    total_received = 0
-
-    for _ in range(MESSAGES_PER_CONNECTION):
-        size = random.randint(1, MAX_MSG_SIZE)
-        data = (
-            random.randbytes(size)
-            if hasattr(random, "randbytes")
-            else bytes(random.getrandbits(8) for _ in range(size))
-        )
-
-        writer.write(data)
-        await writer.drain()
-        total_sent += len(data)
-
-        resp = await reader.readexactly(len(data))
-        total_received += len(resp)
-
-        assert resp == data, f"Echo mismatch on client {client_id}"
-
-    writer.close()
-    await writer.wait_closed()
-    end = time.perf_counter()
-    duration = end - start
-    return total_sent, total_received, duration
-
-
-async def run_tick():
-    tasks = [
-        asyncio.create_task(tcp_echo_client(i)) for i in range(CONCURRENT_CONNECTIONS)
-    ]
-    results = await asyncio.gather(*tasks)
-
-    total_sent = sum(r[0] for r in results)
-    total_received = sum(r[1] for r in results)
-    durations = [r[2] for r in results]
+MAX_IN_FLIGHT = 256  # clients connecting or exchanging messages at the same time
+NS_PER_SECOND = 1_000_000_000
+
+# The proxy copies the whole history of a flow into python on every chunk, so its cost
+# per chunk grows with the age of the flow: connections are recycled after a few ticks
+TICKS_PER_CONNECTION = 16
+
+
+def tune_socket(sock):
+    # asyncio already disables Nagle on TCP transports, set it anyway for other loops
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # SO_SNDBUF / SO_RCVBUF are not set: they turn off the kernel buffer autotuning
+    # and are capped to net.core.[rw]mem_max, below the autotuning limit by default
+
+
+class Client:
+    # Keeps the same connection open for TICKS_PER_CONNECTION ticks
+    # or until the peer closes it, then reconnects on the next tick
+    def __init__(self, client_id: int):
+        self.client_id = client_id
+        self.reader = None
+        self.writer = None
+        self.ticks = 0
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(HOST, PORT)
+        tune_socket(self.writer.get_extra_info("socket"))
+        self.ticks = 0
+
+    async def tick(self, messages: list[bytes]):
+        # Durations stay integer nanoseconds until they are printed
+        start = time.perf_counter_ns()
+        # All the messages of the tick go out in one write and come back in one read
+        data = b"".join(messages)
+
+        try:
+            if self.writer is None or self.ticks >= TICKS_PER_CONNECTION:
+                await self.close()
+                await self.connect()
+                start = time.perf_counter_ns()
+            self.ticks += 1
+
+            # No drain: the reply can only arrive after the data left the write buffer
+            self.writer.write(data)
+            resp = await self.reader.readexactly(len(data))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # After an EOF the writer is not closing, the failure is the only sign of it
+            await self.close()
+            return None
+
+        assert resp == data, f"Echo mismatch on client {self.client_id}"
+
+        duration = time.perf_counter_ns() - start
+        return len(data), len(resp), duration
+
+    async def close(self):
+        if self.writer is None:
+            return
+        writer, self.writer = self.writer, None
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+
+async def bounded(sem: asyncio.Semaphore, coro):
+    async with sem:
+        return await coro
+
+
+async def run_all(coros) -> list:
+    # At most MAX_IN_FLIGHT run at once, the others wait on the semaphore
+    sem = asyncio.Semaphore(MAX_IN_FLIGHT)
+    async with asyncio.TaskGroup() as tg:
+        tasks = [tg.create_task(bounded(sem, coro)) for coro in coros]
+    return [task.result() for task in tasks]
+
+
+# Random data is generated once per tick, each message is a slice of the pool at a
+# random offset, so bytes mixed up between messages or flows fail the echo check
+def random_messages(count: int) -> list[bytes]:
+    pool = os.urandom(MAX_MSG_SIZE * 2)
+    sizes = random.choices(range(1, MAX_MSG_SIZE + 1), k=count)
+    offsets = random.choices(range(MAX_MSG_SIZE), k=count)
+    return [pool[offset : offset + size] for offset, size in zip(offsets, sizes)]
+
+
+async def run_tick(clients: list[Client]):
+    messages = random_messages(len(clients) * MESSAGES_PER_CONNECTION)
+    results = await run_all(
+        client.tick(messages[i : i + MESSAGES_PER_CONNECTION])
+        for client, i in zip(clients, range(0, len(messages), MESSAGES_PER_CONNECTION))
+    )
+    # The clients that lost their connection return None
+    results = [result for result in results if result is not None]
+    failed = len(clients) - len(results)
+    if not results:
+        return 0, 0, 0, 0, 0, failed
+
+    # Transpose once, then every reduction runs on a tuple in C
+    sent, received, durations = zip(*results)
+    total_sent = sum(sent)
+    total_received = sum(received)
 
     min_time = min(durations)
     max_time = max(durations)
-    avg_time = sum(durations) / len(durations)
+    avg_time = sum(durations) // len(durations)
 
-    return total_sent, total_received, min_time, max_time, avg_time
+    return total_sent, total_received, min_time, max_time, avg_time, failed
 
 
 async def main_loop():
-    while True:
-        start_time = time.time()
-        sent, received, min_t, max_t, avg_t = await run_tick()
-        elapsed = time.time() - start_time
-
-        print(
-            f"""Tick finished: Sent {sent} bytes, Received {received} bytes in {elapsed:.2f}s
+    clients = [Client(i) for i in range(CONCURRENT_CONNECTIONS)]
+    await run_all(client.connect() for client in clients)
+
+    try:
+        while True:
+            start_time = time.perf_counter_ns()
+            sent, received, min_t, max_t, avg_t, failed = await run_tick(clients)
+            elapsed = (time.perf_counter_ns() - start_time) / NS_PER_SECOND
+            min_t, max_t, avg_t = (t / NS_PER_SECOND for t in (min_t, max_t, avg_t))
+
+            print(
+                f"""Tick finished: Sent {sent} bytes, Received {received} bytes in {elapsed:.2f}s
 Throughput: {sent / elapsed / 1024:.2f} KB/s
 Request time: min={min_t:.3f}s max={max_t:.3f}s avg={avg_t:.3f}s
+Failed clients: {failed}
 """
-        )
+            )
 
-        await asyncio.sleep(max(0, TICK_INTERVAL - elapsed))
+            await asyncio.sleep(max(0, TICK_INTERVAL - elapsed))
+    finally:
+        await asyncio.gather(
+            *(client.close() for client in clients), return_exceptions=True
+        )
 
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main_loop())
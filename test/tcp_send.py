@@ -11,16 +11,19 @@ with socket.create_connection((HOST, PORT)) as sock:
 
     # sock.shutdown(socket.SHUT_WR)  # Optional: signal no more data will be sent
 
-    received = b""
+    # Receive in place, without a bytes object per recv and the copy of every +=
     expected_len = len(payload)
+    received = bytearray(expected_len)
+    view = memoryview(received)
+    offset = 0
 
-    while len(received) < expected_len:
-        chunk = sock.recv(4096)
-        if not chunk:
+    while offset < expected_len:
+        n = sock.recv_into(view[offset:])
+        if not n:
             break
-        received += chunk
+        offset += n
 
-    print(f"Received {len(received)} bytes.")
-    assert received == payload, "Received data does not match sent data!"
+    print(f"Received {offset} bytes.")
+    assert received[:offset] == payload, "Received data does not match sent data!"
 
     print("Success! Closing connection.")
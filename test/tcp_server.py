@@ -1,33 +1,52 @@
 import asyncio
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 HOST = "0.0.0.0"
 PORT = 8000
 
-async def handle_echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    addr = writer.get_extra_info('peername')
-    print(f"Connection from {addr}")
-
-    try:
-        while True:
-            data = await reader.read(4096)
-            if not data:
-                print(f"Connection closed by {addr}")
-                break
-
-            writer.write(data)
-            await writer.drain()
-
-    except asyncio.CancelledError:
-        pass
-    except Exception as e:
-        print(f"Error with {addr}: {e}")
-    finally:
-        writer.close()
-        await writer.wait_closed()
-        print(f"Connection with {addr} closed")
+BUFFER_SIZE = 64 * 1024
+
+class EchoProtocol(asyncio.BufferedProtocol):
+    # The event loop reads straight into the same buffer, no bytes object per read
+    def __init__(self):
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.transport = None
+        self.addr = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        print(f"Connection from {self.addr}")
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        # Slicing copies, the transport may keep the data after write returns
+        self.transport.write(self.buffer[:nbytes])
+
+    # Stop reading while the peer is not consuming the echo
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def eof_received(self):
+        print(f"Connection closed by {self.addr}")
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            print(f"Error with {self.addr}: {exc}")
+        print(f"Connection with {self.addr} closed")
 
 async def main():
-    server = await asyncio.start_server(handle_echo, HOST, PORT)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(EchoProtocol, HOST, PORT)
     addr = server.sockets[0].getsockname()
     print(f"Serving on {addr}")
 
@@ -35,4 +54,6 @@ async def main():
         await server.serve_forever()
 
 if __name__ == '__main__':
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
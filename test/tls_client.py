@@ -1,4 +1,5 @@
 import asyncio
+import os
 import random
 import time
 import ssl
@@ -14,21 +15,16 @@ MAX_MSG_SIZE = 1024
 TICK_INTERVAL = 4
 
 
-async def tcp_echo_client(client_id: int, ssl_context: ssl.SSLContext):
+async def tcp_echo_client(
+    client_id: int, ssl_context: ssl.SSLContext, messages: list[bytes]
+):
     start = time.perf_counter()
     reader, writer = await asyncio.open_connection(HOST, PORT, ssl=ssl_context)
 
     total_sent = 0
     total_received = 0
 
-    for _ in range(MESSAGES_PER_CONNECTION):
-        size = random.randint(1, MAX_MSG_SIZE)
-        data = (
-            random.randbytes(size)
-            if hasattr(random, "randbytes")
-            else bytes(random.getrandbits(8) for _ in range(size))
-        )
-
+    for data in messages:
         writer.write(data)
         await writer.drain()
         total_sent += len(data)
@@ -45,10 +41,22 @@ async def tcp_echo_client(client_id: int, ssl_context: ssl.SSLContext):
     return total_sent, total_received, duration
 
 
+# Random data is generated once per tick, each message is a slice of the pool at a
+# random offset, so bytes mixed up between messages or flows fail the echo check
+def random_messages(count: int) -> list[bytes]:
+    pool = os.urandom(MAX_MSG_SIZE * 2)
+    sizes = random.choices(range(1, MAX_MSG_SIZE + 1), k=count)
+    offsets = random.choices(range(MAX_MSG_SIZE), k=count)
+    return [pool[offset : offset + size] for offset, size in zip(offsets, sizes)]
+
+
 async def run_tick(ssl_context: ssl.SSLContext):
+    messages = random_messages(CONCURRENT_CONNECTIONS * MESSAGES_PER_CONNECTION)
     tasks = [
-        asyncio.create_task(tcp_echo_client(i, ssl_context))
-        for i in range(CONCURRENT_CONNECTIONS)
+        asyncio.create_task(
+            tcp_echo_client(i, ssl_context, messages[j : j + MESSAGES_PER_CONNECTION])
+        )
+        for i, j in enumerate(range(0, len(messages), MESSAGES_PER_CONNECTION))
     ]
     results = await asyncio.gather(*tasks)
 
@@ -1,5 +1,14 @@
 import asyncio
+import os
+import signal
+import socket
 import ssl
+import sys
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 HOST = "127.0.0.1"
 PORT = 8443
@@ -8,41 +17,99 @@ CERT_FILE = "./test/keys/cert.pem"
 KEY_FILE = "./test/keys/key.pem"
 CA_FILE = "./test/keys/ca-cert.pem"
 
-async def handle_echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-    addr = writer.get_extra_info('peername')
-    print(f"Connection from {addr}")
+SESSION_TICKETS = 4
+BUFFER_SIZE = 16 * 1024
 
-    try:
-        while True:
-            data = await reader.read(4096)
-            if not data:
-                print(f"Connection closed by {addr}")
-                break
-
-            writer.write(data)
-            await writer.drain()
-
-    except asyncio.CancelledError:
-        pass
-    except Exception as e:
-        print(f"Error with {addr}: {e}")
-    finally:
-        writer.close()
-        await writer.wait_closed()
-        print(f"Connection with {addr} closed")
+# Each worker process binds its own socket with SO_REUSEPORT,
+# the kernel balances the connections between them
+WORKERS = 4
+
+def tune_socket(sock):
+    # asyncio already disables Nagle on TCP transports, set it anyway for other loops
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # SO_SNDBUF / SO_RCVBUF are not set: they turn off the kernel buffer autotuning
+    # and are capped to net.core.[rw]mem_max, below the autotuning limit by default
+
+class EchoProtocol(asyncio.BufferedProtocol):
+    # The TLS transport decrypts straight into the same buffer, without streams
+    def __init__(self):
+        self.buffer = bytearray(BUFFER_SIZE)
+        self.transport = None
+        self.addr = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info('peername')
+        tune_socket(transport.get_extra_info('socket'))
+        print(f"Connection from {self.addr}")
+
+    def get_buffer(self, sizehint):
+        return self.buffer
+
+    def buffer_updated(self, nbytes):
+        # Slicing copies, the transport may keep the data after write returns
+        self.transport.write(self.buffer[:nbytes])
+
+    # Stop reading while the peer is not consuming the echo
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def eof_received(self):
+        print(f"Connection closed by {self.addr}")
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            print(f"Error with {self.addr}: {exc}")
+        print(f"Connection with {self.addr} closed")
 
 async def main():
     ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
     ssl_context.load_cert_chain(certfile=CERT_FILE, keyfile=KEY_FILE)
     ssl_context.load_verify_locations(cafile=CA_FILE)
     #ssl_context.verify_mode = ssl.CERT_OPTIONAL
+    # TLS 1.3 only with X25519 key exchange, the TLS 1.3 suites are all AEAD
+    # and set_ciphers does not apply to them
+    ssl_context.minimum_version = ssl.TLSVersion.TLSv1_3
+    ssl_context.set_ecdh_curve("X25519")
+    # Session tickets let reconnecting clients resume instead of doing a full handshake
+    ssl_context.options &= ~ssl.OP_NO_TICKET
+    ssl_context.num_tickets = SESSION_TICKETS
 
-    server = await asyncio.start_server(handle_echo, HOST, PORT, ssl=ssl_context)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_server(
+        EchoProtocol, HOST, PORT, ssl=ssl_context, reuse_port=True
+    )
     addr = server.sockets[0].getsockname()
-    print(f"Serving on {addr}")
+    print(f"Serving on {addr} (pid {os.getpid()})")
 
     async with server:
         await server.serve_forever()
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    workers = []
+    for _ in range(WORKERS - 1):
+        pid = os.fork()
+        if pid == 0:
+            workers = []
+            break
+        workers.append(pid)
+
+    # The parent stops the workers when it exits, otherwise they keep the port bound
+    if workers:
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    try:
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        asyncio.run(main())
+    finally:
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            os.waitpid(pid, 0)